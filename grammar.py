@@ -1,16 +1,17 @@
-from typing import Tuple, List, Dict, Optional, Set
+from typing import Tuple, List, Dict, Optional, Set, Iterator
 from extensions.output_template.symbols import Symbol, Terminal, NonTerminal, Sequence, Alternative, Repeat, RegExp, \
-    AnyToken
+    AnyToken, Collection
 from extensions.output_template.state_machine import Advance, Matcher
-from extensions.output_template.utils import shared, AllowedTokens
-import torch, re
+from extensions.output_template.utils import shared, AllowedTokens, get_eos_token_id
+import torch, re, copy
 
 RE_RULE = re.compile(r'\s*([-a-z]+)\s*::=\s*(.*)', re.MULTILINE | re.DOTALL)
 RE_NEWLINE = re.compile(r'[ \t]*\n[ \t\n]*(.*)', re.MULTILINE | re.DOTALL)
 RE_NONTERMINAL = re.compile(r'[ \t]*([-a-z_]+)[ \t]*(.*)', re.DOTALL)
 RE_ANYTOKEN = re.compile(r'[ \t]*\.[ \t]*\*[ \t]*(.*)', re.DOTALL)
 RE_OR = re.compile(r'[ \t\n]*\|[ \t]*(.*)', re.MULTILINE | re.DOTALL)
-RE_COMMENT = re.compile(r'([^#]*)#[^\n]*(.*)', re.MULTILINE | re.DOTALL)
+RE_COMMENT = re.compile(r'#[^\n]*')
+ALLOWED_CACHE_SIZE = 1024
 
 
 class Grammar:
@@ -18,23 +19,46 @@ class Grammar:
 
     def __init__(self, definition: str):
         self.rules: Dict[str, Symbol] = {}
+        self.resolved: Dict[NonTerminal, Symbol] = {}
+        self.allowed_cache: Dict[tuple, AllowedTokens] = {}
+        self.matcher_cache: Dict[tuple, AllowedTokens] = {}
         self.active_matcher: Optional[Matcher] = None
+        self.eos_token_id: Optional[int] = None
+        self.only_eos: Optional[AllowedTokens] = None
+        # Definition and tokenizer for which rules were parsed and caches filled
+        self.parsed_for: tuple = (None, None)
         self.reset(definition)
 
     def stop(self):
         self.active_matcher = None
 
+    def clone(self) -> "Grammar":
+        """
+        Returns copy of grammar in same state, that can be advanced independently.
+        Rules and caches are shared.
+        """
+        rv = copy.copy(self)
+        rv.active_matcher = self.active_matcher.clone() if self.active_matcher else None
+        return rv
+
     def reset(self, definition: str = None):
         self.stop()
-        if definition:
+        if shared.tokenizer:
+            # Cached here so it's not looked up on every generated token
+            self.eos_token_id = get_eos_token_id()
+            self.only_eos = AllowedTokens(allowed=frozenset({self.eos_token_id}), allow_eos=True)
+        if definition and self.parsed_for != (definition, shared.tokenizer):
+            # Same template is usually used for every generation. Parsing it only once
+            # keeps rules and everything cached for them.
             text = definition
+            self.parsed_for = (None, None)
             self.rules = {}
+            self.resolved = {}
+            self.allowed_cache = {}
+            self.matcher_cache = {}
 
             # Strip comments
-            m = RE_COMMENT.match(text)
-            while m:
-                text = m.group(1) + m.group(2)
-                m = RE_COMMENT.match(text)
+            text = RE_COMMENT.sub('', text)
 
             while text:
                 m = RE_RULE.match(text)
@@ -48,12 +72,41 @@ class Grammar:
             if "root" not in self.rules:
                 raise ValidationError("missing 'root' rule")
             for rule in self.rules.values():
+                # Validation also resolves (and so caches) every NonTerminal in grammar
                 rule.validate(self)
+            self.parsed_for = (definition, shared.tokenizer)
 
         self.enter_rule("root")
 
+    def walk(self) -> Iterator[Symbol]:
+        """ Yields every symbol used in grammar (except NonTerminals) """
+        stack: List[Symbol] = list(self.rules.values())
+        while stack:
+            symbol = stack.pop()
+            if isinstance(symbol, Collection):
+                stack += symbol.items
+            elif isinstance(symbol, Repeat):
+                stack.append(symbol.item)
+            elif not isinstance(symbol, NonTerminal):
+                yield symbol
+
+    def precompute(self):
+        """
+        Computes allowed tokens for every terminal and regexp in grammar,
+        so it doesn't have to be done while generating.
+        Requires token dictionary to be available.
+        """
+        for symbol in self.walk():
+            if isinstance(symbol, (Terminal, RegExp)):
+                symbol.enter(self).get_allowed_tokens(self)
+
     def resolve(self, symbol: "Symbol") -> "Symbol":
         # Resolves NonTerminal into rule and returns Symbol it represents
+        if not isinstance(symbol, NonTerminal):
+            return symbol
+        if symbol in self.resolved:
+            return self.resolved[symbol]
+        nonterminal = symbol
         dont_loop: Set[Terminal] = set([symbol])
         while isinstance(symbol, NonTerminal):
             dont_loop.add(symbol)
@@ -62,6 +115,7 @@ class Grammar:
             if self.rules[symbol.name] in dont_loop:
                 raise ValidationError(f"infinite loop detected at symbol '{symbol.name}'")
             symbol = self.rules[symbol.name]
+        self.resolved[nonterminal] = symbol
         return symbol
 
     def enter_rule(self, name: str):
@@ -86,31 +140,68 @@ class Grammar:
         """
         return self.active_matcher.get_effective_matcher() if self.active_matcher else None
 
+    def advance_many(self, token_ids: List[int]) -> int:
+        """
+        Advances by given tokens one after another for as long as each one is allowed
+        in state grammar gets to. Returns number of tokens used, so caller checking
+        multiple tokens at once (e.g. draft from speculative decoding) knows where it diverged.
+        Grammar is left in state after last token used.
+        """
+        for (i, token_id) in enumerate(token_ids):
+            if not self.active_matcher or not self.get_current_allowed_tokens().is_allowed(token_id):
+                return i
+            self.advance(token_id)
+        return len(token_ids)
+
+    def get_allowed_tokens(self, matcher: Matcher) -> AllowedTokens:
+        """
+        Returns tokens allowed by given matcher, cached by its state.
+        Used by matchers to compute tokens allowed by their items, so that same configuration
+        reached by different path (e.g. while looking ahead) is not computed again.
+        """
+        key = matcher.get_state_key()
+        rv = self.matcher_cache.get(key)
+        if rv is None:
+            rv = matcher.get_allowed_tokens(self)
+            if len(self.matcher_cache) >= ALLOWED_CACHE_SIZE:
+                del self.matcher_cache[next(iter(self.matcher_cache))]
+            self.matcher_cache[key] = rv
+        return rv
+
     def update_scores(self, scores: torch.FloatTensor) -> torch.FloatTensor:
         """
         Calculates probability scores of next token according to current state.
         May update and return same object as one that was passed as argument.
         """
-        # TODO: how to cache or optimize this?
-        if self.active_matcher:
-            allowed = self.active_matcher.get_allowed_tokens(self)
-            if allowed.look_ahead:
-                allowed.allow_eos = True
+        self.get_current_allowed_tokens().apply(scores)
+        return scores
 
-            allowed.apply(scores)
+    def get_current_allowed_tokens(self) -> AllowedTokens:
+        """ Returns tokens allowed in current state """
+        if self.active_matcher:
+            # Grammar goes through same states over and over (e.g. inside repeat),
+            # so allowed tokens are cached by state of matcher
+            key = self.active_matcher.get_state_key()
+            allowed = self.allowed_cache.pop(key, None)
+            if allowed is None:
+                allowed = self.active_matcher.get_allowed_tokens(self)
+                if allowed.look_ahead:
+                    allowed = allowed.set_eos()
+                if len(self.allowed_cache) >= ALLOWED_CACHE_SIZE:
+                    del self.allowed_cache[next(iter(self.allowed_cache))]
+            # Re-inserted so least recently used entry is first
+            self.allowed_cache[key] = allowed
+            return allowed
         else:
             # Grammar reached terminal token. Force EOS
-            AllowedTokens(allowed={int(shared.tokenizer.eos_token_id)}, allow_eos=True).apply(scores)
-        return scores
+            return self.only_eos
 
     def advance(self, token_id: int):
         try:
             if self.active_matcher:
-                # from extensions.output_template.script import logger
-                # logger.warning(f"Feeding {token_id} into {self.active_matcher}.")
                 a = self.active_matcher.advance(self, token_id)
                 if a == Advance.Reject:
-                    if token_id == shared.tokenizer.eos_token_id:
+                    if token_id == self.eos_token_id:
                         self.active_matcher = None
                     else:
                         raise GenerationError
@@ -158,9 +249,9 @@ def parse_sequence(text: str, parentheses=False) -> Tuple[Sequence, str]:
                 text = text[end_index+1:]
             except ValueError:
                 raise GrammarError(f"unmatched {text[0]}")
-        elif RE_NONTERMINAL.match(text):
+        elif m := RE_NONTERMINAL.match(text):
             # Non-terminal rule
-            t, text = RE_NONTERMINAL.match(text).groups()
+            t, text = m.groups()
             seq.append(NonTerminal(t))
         elif text[0] in " \t":
             # Whitespace
@@ -185,41 +276,51 @@ def parse_sequence(text: str, parentheses=False) -> Tuple[Sequence, str]:
         elif parentheses and text[0] == ")":
             text = text[1:]
             break
-        elif RE_ANYTOKEN.match(text):
+        elif m := RE_ANYTOKEN.match(text):
             # '.*' rule
-            text, = RE_ANYTOKEN.match(text).groups()
+            text, = m.groups()
             seq.append(AnyToken())
         elif text[0] in "*?+":
             # Repeat rule
             if not seq:
                 raise GrammarError(f"unexpected '{text[0]}'")
             left = seq.pop()
-            if text[0] == "+":
-                # A+ is converted into sequence (A A*)
-                if text[0] in "+" and isinstance(left, RegExp):
-                    # If child is regexp, extend its rule so multi-character tokens are matched
-                    left = RegExp(left.value + text[0])
-                seq.append(Sequence([left, Repeat("*", left)]))
-            else:
-                seq.append(Repeat(text[0], left))
+            if text[0] == "+" and isinstance(left, RegExp):
+                # If child is regexp, extend its rule so multi-character tokens are matched
+                left = RegExp(left.value + text[0])
+            seq.append(Repeat(text[0], left))
             text = text[1:]
-        elif RE_OR.match(text):
-            text, = RE_OR.match(text).groups()
+        elif m := RE_OR.match(text):
+            text, = m.groups()
             if not seq:
                 raise GrammarError(f"unexpected '|'")
             left = seq.pop()
             right, text = parse_rule(text, parentheses=parentheses)
             seq.append(Alternative([left, right]))
             break
-        elif RE_NEWLINE.match(text):
+        elif m := RE_NEWLINE.match(text):
             # Newline
-            text, = RE_NEWLINE.match(text).groups()
+            text, = m.groups()
             if not parentheses:
                 break
         else:
             raise GrammarError(f"unexpected '{text[0:5]}'...")
 
-    return Sequence(seq), text
+    return Sequence(merge_terminals(seq)), text
+
+
+def merge_terminals(seq: List[Symbol]) -> List[Symbol]:
+    """
+    Merges consecutive terminals into one, so ("a" "b") is matched same way as ("ab").
+    Done only after whole sequence is parsed, as repeat operator applies only to last terminal.
+    """
+    rv = []
+    for s in seq:
+        if rv and isinstance(s, Terminal) and isinstance(rv[-1], Terminal) and s.value and rv[-1].value:
+            rv[-1] = Terminal(rv[-1].value + s.value)
+        else:
+            rv.append(s)
+    return rv
 
 
 def parse_rule(text: str, parentheses=False) -> Tuple[Symbol, str]:
@@ -1,7 +1,8 @@
-from typing import Optional
+from typing import Optional, Dict
 from extensions.output_template.grammar import Grammar
-from extensions.output_template.utils import shared
+from extensions.output_template.utils import shared, MINUS_INF
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future
 import torch, transformers
 try:
     from modules.logging_colors import logger
@@ -15,6 +16,8 @@ except ModuleNotFoundError:
 
 
 EMPTY_GRAMMAR = "root ::= .*"
+# Used to precompute allowed tokens while prompt is being processed
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="output_template")
 
 params = {
     "grammar": Grammar(EMPTY_GRAMMAR),
@@ -22,7 +25,10 @@ params = {
     "template": "",
     "token_dictionary": None,
     "used_tokenizer": None,
+    "token_trie": None,
+    "token_blob": None,
     "scores_size": 0,
+    "warmup_future": None,
 }
 
 
@@ -31,26 +37,76 @@ class TemplatingLogitsProcessor(transformers.LogitsProcessor):
     def __init__(self):
         super().__init__()
         self.last_input_size = 0
+        # Used only when generating multiple sequences at once
+        self.prompt_size = 0
+        self.rows: Dict[tuple, Grammar] = {}
 
     def __call__(self, input_ids: Optional[torch.LongTensor], scores: torch.FloatTensor):
         if params["enabled"]:
-            params["scores_size"] = len(scores[0])
+            # Shape is known without touching data, so this doesn't wait for device
+            params["scores_size"] = scores.shape[-1]
             grammar: Grammar = params["grammar"]
-
+            warmup: Optional[Future] = params["warmup_future"]
+            if warmup and warmup.done():
+                # If it's not done yet, allowed tokens are just computed as needed
+                params["warmup_future"] = None
+                warmup.result()
+
+            if input_ids is not None and len(input_ids) > 1:
+                return self.update_batch(grammar, input_ids, scores)
             if input_ids is not None:
                 # input_ids are None when running from tests.
-                input_size = len(input_ids[0])
+                input_size = input_ids.shape[-1]
                 if input_size <= self.last_input_size:
                     logger.warning("output_template: input size unexpectedly decreased. Restarting grammar (except wrong output)")
                     grammar.reset()
                 elif self.last_input_size != 0:
-                    for token_id in input_ids[0][self.last_input_size:]:
-                        grammar.advance(int(token_id))
+                    # Converted to python ints at once, so there's only one copy from device
+                    tokens = input_ids[0][self.last_input_size:].tolist()
+                    if grammar.advance_many(tokens) < len(tokens) and grammar.active_matcher:
+                        logger.warning("LLM failed to generate token conforming to grammar")
+                        grammar.stop()
                 self.last_input_size = input_size
 
             return grammar.update_scores(scores)
         return scores
 
+    def update_batch(self, grammar: Grammar, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        """
+        Used when generating multiple sequences at once (e.g. with beam search).
+        Every row gets its own copy of grammar. Rows may be reordered or duplicated between calls,
+        so copy is found by tokens generated so far instead of by position.
+        """
+        if not self.prompt_size:
+            self.prompt_size = input_ids.shape[-1]
+            self.rows = {(): grammar.clone()}
+        rows: Dict[tuple, Grammar] = {}
+        allowed = []
+        for tokens in input_ids[:, self.prompt_size:].tolist():
+            key = tuple(tokens)
+            if key not in rows:
+                g = self.rows.get(key)
+                if g is None:
+                    parent = self.rows.get(key[:-1])
+                    if parent is None:
+                        logger.warning("output_template: unexpected input in batch. Restarting grammar (except wrong output)")
+                        g = grammar.clone()
+                        g.reset()
+                    else:
+                        g = parent.clone()
+                        g.advance(key[-1])
+                rows[key] = g
+            allowed.append(rows[key].get_current_allowed_tokens())
+        self.rows = rows
+
+        if all(a is allowed[0] for a in allowed):
+            # Common case of all rows being in same state. Single mask is broadcast over entire batch
+            allowed[0].apply(scores)
+        else:
+            # Masks of rows are cached on scores device, so they are stacked there and applied at once
+            scores.masked_fill_(torch.stack([a.get_banned_mask(scores) for a in allowed]), MINUS_INF)
+        return scores
+
 
 def logits_processor_modifier(processor_list, input_ids):
     """
@@ -62,13 +118,6 @@ def logits_processor_modifier(processor_list, input_ids):
     return processor_list
 
 
-def token_generated_callback(input_ids, scores):
-    if params["enabled"]:
-        grammar: Grammar = params["grammar"]
-        new_token = input_ids[0][-1]
-        grammar.advance(int(new_token))
-
-
 def input_modifier(string, state, is_chat=False):
     """
     Initializes template and appends initial simple text to input.
@@ -81,6 +130,10 @@ def input_modifier(string, state, is_chat=False):
                 grammar.reset(state["grammar"] or EMPTY_GRAMMAR)
             else:
                 grammar.reset(params["template"])
+            if params["used_tokenizer"] is shared.tokenizer:
+                # Token dictionary for current model is already known.
+                # Allowed tokens are computed in background while LLM processes the prompt
+                params["warmup_future"] = executor.submit(grammar.precompute)
             params["enabled"] = True
         else:
             params["enabled"] = False
@@ -1,6 +1,8 @@
-from typing import List, Optional, Set
-from extensions.output_template.utils import get_token_dictionary, AllowedTokens
+from typing import List, Optional, FrozenSet, Dict
+from extensions.output_template.utils import get_token_dictionary, get_token_trie, get_token_blob, \
+    AllowedTokens
 from enum import IntEnum
+import copy
 
 
 class Advance(IntEnum):
@@ -26,6 +28,20 @@ class Matcher:
         """
         return repr(self.symbol)
 
+    def reset(self, g: "Grammar"):
+        """
+        Returns matcher into state it had right after symbol was entered.
+        Allows to reuse matchers instead of entering same symbol again.
+        """
+        raise NotImplementedError(f"reset on {self.__class__.__name__}")
+
+    def clone(self) -> "Matcher":
+        """
+        Returns copy of matcher that can be advanced independently.
+        Symbols (and everything cached on them) stay shared.
+        """
+        return copy.copy(self)
+
     def get_effective_matcher(self) -> Optional["Matcher"]:
         raise NotImplementedError(f"get_effective_matcher on {self.__class__.__name__}") 
 
@@ -42,6 +58,14 @@ class Matcher:
     def get_allowed_tokens(self, g: "Grammar") -> AllowedTokens:
         raise NotImplementedError(f"get_allowed_tokens on {self.__class__.__name__}")
 
+    def get_state_key(self) -> tuple:
+        """
+        Returns hashable value describing current state.
+        Matchers with equal state keys are guaranteed to allow same tokens, so this
+        is used to cache result of get_allowed_tokens.
+        """
+        return (self.symbol, )
+
 
 class TerminalMatcher(Matcher):
     symbol: "Terminal"
@@ -50,6 +74,9 @@ class TerminalMatcher(Matcher):
         super().__init__(t)
         self.index = 0
 
+    def reset(self, g: "Grammar"):
+        self.index = 0
+
     def debug(self) -> str:
         if self.index <= 0 or self.index >= len(self.symbol.value):
             return repr(self.symbol)
@@ -58,24 +85,35 @@ class TerminalMatcher(Matcher):
     def get_effective_matcher(self) -> "Matcher":
         return self
 
+    def get_state_key(self) -> tuple:
+        return (self.symbol, self.index)
+
     def get_allowed_tokens(self, g: "Grammar") -> AllowedTokens:
-        if self.index not in self.symbol.allowed_cache:
-            d = get_token_dictionary()
-            allowed = set()
-            for token_id in d:
-                if d[token_id] and d[token_id] == self.symbol.value[self.index:self.index+len(d[token_id])]:
-                    allowed.add(token_id)
-            self.symbol.allowed_cache[self.index] = allowed
-        return AllowedTokens(allowed=self.symbol.allowed_cache[self.index])
+        if not self.symbol.allowed_cache:
+            # Allowed are all tokens that are prefix of rest of the terminal.
+            # Computed for every possible index at once, so later calls are just lookup.
+            # Same rest of text is shared by all terminals (and by every time template is parsed again)
+            trie = get_token_trie()
+            tokens_cache = self.symbol.tokens_cache
+            for i in range(len(self.symbol.value)):
+                rest = self.symbol.value[i:]
+                if rest not in tokens_cache:
+                    tokens_cache[rest] = AllowedTokens(allowed=frozenset(trie.prefixes_of(rest)))
+            self.symbol.allowed_cache = [tokens_cache[self.symbol.value[i:]] for i in range(len(self.symbol.value))]
+        return self.symbol.allowed_cache[self.index]
 
     def enter_in_middle(self, g: "Grammar", token_id: int) -> Advance:
         if self.index == 0:
             # Special case, allow entering mid-token
-            d = get_token_dictionary()
-            t = get_suffix_prefix(d[token_id], self.symbol.value)
-            if not t:
+            overlaps = self.symbol.overlap_cache.get(self.symbol.value)
+            if overlaps is not None:
+                # Already computed for preceding regexp
+                k = overlaps.get(token_id, 0)
+            else:
+                k = len(get_suffix_prefix(get_token_dictionary()[token_id], self.symbol.value))
+            if not k:
                 return Advance.Reject
-            self.index += len(t)
+            self.index += k
             if self.index >= len(self.symbol.value):
                 return Advance.Done
             return Advance.Again
@@ -83,18 +121,29 @@ class TerminalMatcher(Matcher):
     def advance(self, g: "Grammar", token_id: int) -> Advance:
         d = get_token_dictionary()
         t = d[token_id]
-        if t != self.symbol.value[self.index:self.index + len(t)]:
+        if len(t) == 1:
+            # Most of the tokens matched against terminals are single characters
+            if self.symbol.value[self.index] != t:
+                return Advance.Reject
+            self.index += 1
+        elif not self.symbol.value.startswith(t, self.index):
             return Advance.Reject
-        self.index += len(t)
+        else:
+            self.index += len(t)
         if self.index >= len(self.symbol.value):
             return Advance.Done
         return Advance.Again
 
 
 def get_suffix_prefix(suffix_from, prefix_from) -> str:
-    i = 1
-    while i <= min(len(suffix_from), len(prefix_from)):
-        if suffix_from[-i:] != prefix_from[:i]:
+    if not suffix_from or not prefix_from or suffix_from[-1] != prefix_from[0]:
+        # Called for (almost) every token in vocabulary and for most of them
+        # overlap ends before it even starts, so there's no need to slice anything
+        return ""
+    i = 2
+    n = min(len(suffix_from), len(prefix_from))
+    while i <= n:
+        if not suffix_from.endswith(prefix_from[:i]):
             break
         i += 1
     return prefix_from[:i-1]
@@ -109,47 +158,96 @@ class RegExpMatcher(Matcher):
     def debug(self) -> str:
         return f"""r{self.symbol.value}"""
 
+    def reset(self, g: "Grammar"):
+        pass
+
     def get_effective_matcher(self) -> "Matcher":
         return self
 
     def get_allowed_tokens(self, g: "Grammar") -> AllowedTokens:
+        # Banned tokens depend on following terminal as well
+        key = (self.symbol.value, self.symbol.next.value if self.symbol.next else None)
+        if key in self.symbol.tokens_cache:
+            return self.symbol.tokens_cache[key]
         if self.symbol.negative:
-            if self.symbol.value not in self.symbol.banned_cache:
+            rejected = self.get_rejected_set()
+            banned = set(rejected)
+            if self.symbol.next:
                 d = get_token_dictionary()
-                banned = set()
-                for token_id in d:
-                    if self.symbol.re.search(d[token_id]):
-                        if self.symbol.next:
-                            t = d[token_id]
-                            # Check if there's prefix of next terminal that is also suffix of this token
-                            s = get_suffix_prefix(t, self.symbol.next.value)
-                            # If yes, check if rest of this token can be allowed
-                            if s and len(s) < len(t) and not self.symbol.re.search(t[0:-len(s)]):
-                                # Yes, allow that token
-                                pass
-                            else:
-                                # No, ban entire token
-                                banned.add(token_id)
-                        else:
-                            banned.add(token_id)
-                self.symbol.banned_cache[self.symbol.value] = banned
-            return AllowedTokens(banned=self.symbol.banned_cache[self.symbol.value])
+                for (token_id, overlap) in self.get_overlaps().items():
+                    # Token ends with prefix of next terminal. Check if rest of this token can be allowed
+                    t = d[token_id]
+                    if token_id in rejected and overlap < len(t) and not self.symbol.re.search(t[0:-overlap]):
+                        # Yes, allow that token
+                        banned.discard(token_id)
+            rv = AllowedTokens(banned=frozenset(banned))
         else:
-            if self.symbol.value not in self.symbol.allowed_cache:
+            rv = AllowedTokens(allowed=self.get_allowed_set())
+        self.symbol.tokens_cache[key] = rv
+        return rv
+
+    def get_overlaps(self) -> Dict[int, int]:
+        """
+        Returns dict of tokens that end with prefix of next terminal, mapped to length of that prefix.
+        Same as calling get_suffix_prefix on every token, but tokens are scanned only
+        once for every prefix length.
+        """
+        value = self.symbol.next.value
+        overlap_cache = self.symbol.next.overlap_cache
+        if value not in overlap_cache:
+            overlaps = {}
+            blob = get_token_blob()
+            if blob.SEPARATOR in value:
                 d = get_token_dictionary()
-                allowed = set()
-                for token_id in d:
-                    if self.symbol.re.match(d[token_id]):
-                        allowed.add(token_id)
-                self.symbol.allowed_cache[self.symbol.value] = allowed
-            return AllowedTokens(allowed=self.symbol.allowed_cache[self.symbol.value])
+                for (token_id, t) in d.items():
+                    s = get_suffix_prefix(t or "", value)
+                    if s:
+                        overlaps[token_id] = len(s)
+            else:
+                # Token overlaps by k characters only if it ends with every prefix of next
+                # terminal up to length k, same as in get_suffix_prefix
+                current = blob.ending_with(value[0])
+                k = 1
+                while current:
+                    if k < len(value):
+                        longer = current & blob.ending_with(value[:k + 1])
+                    else:
+                        longer = set()
+                    for token_id in current - longer:
+                        overlaps[token_id] = k
+                    current = longer
+                    k += 1
+            overlap_cache[value] = overlaps
+        return overlap_cache[value]
+
+    def get_rejected_set(self) -> FrozenSet[int]:
+        """ Returns set of tokens containing character matching negative regexp """
+        if self.symbol.value not in self.symbol.rejected_cache:
+            blob = get_token_blob()
+            if blob.can_scan(self.symbol.re):
+                rejected = blob.containing(self.symbol.re)
+            else:
+                rejected = get_token_trie().containing(self.symbol.re.search)
+            self.symbol.rejected_cache[self.symbol.value] = frozenset(rejected)
+        return self.symbol.rejected_cache[self.symbol.value]
+
+    def get_allowed_set(self) -> FrozenSet[int]:
+        """ Returns set of tokens matching positive regexp """
+        if self.symbol.value not in self.symbol.allowed_cache:
+            # Regexp is always single character class, optionally followed by '+'.
+            # Without '+', only single-character tokens may match.
+            self.symbol.allowed_cache[self.symbol.value] = frozenset(get_token_trie().consisting_of(
+                self.symbol.re.match,
+                max_length=0 if self.symbol.value.endswith("+") else 1
+            ))
+        return self.symbol.allowed_cache[self.symbol.value]
 
     def advance(self, g: "Grammar", token_id: int) -> Advance:
-        d = get_token_dictionary()
+        # Same sets as used to generate scores, so regexp doesn't have to be matched again
         if self.symbol.negative:
-            if self.symbol.re.search(d[token_id]):
+            if token_id in self.get_rejected_set():
                 return Advance.Reject
-        elif not self.symbol.re.match(d[token_id]):
+        elif token_id not in self.get_allowed_set():
             return Advance.Reject
         # TODO: use index? How to deal with tokens that match partially?
         return Advance.Done
@@ -157,15 +255,19 @@ class RegExpMatcher(Matcher):
 
 class AnyTokenMatcher(Matcher):
     symbol: "AnyToken"
+    allowed = AllowedTokens(allow_eos=True)
 
     def debug(self) -> str:
         return ".*"
 
+    def reset(self, g: "Grammar"):
+        pass
+
     def get_effective_matcher(self) -> "Matcher":
         return self
 
     def get_allowed_tokens(self, g: "Grammar") -> AllowedTokens:
-        return AllowedTokens(allow_eos=True)
+        return self.allowed
 
     def advance(self, g: "Grammar", token_id: int) -> Advance:
         return Advance.Again
@@ -179,6 +281,18 @@ class SequenceMatcher(Matcher):
         self.items = items
         self.index = 0
 
+    def reset(self, g: "Grammar"):
+        # Same as in Sequence.enter, items after first are entered once sequence gets to them
+        self.index = 0
+        self.items[0].reset(g)
+        for i in range(1, len(self.items)):
+            self.items[i] = None
+
+    def clone(self) -> "SequenceMatcher":
+        rv = copy.copy(self)
+        rv.items = [i.clone() if i else None for i in self.items]
+        return rv
+
     def debug(self) -> str:
         return f'''({" ".join([
             f"[{self.items[i].debug()}]" if i == self.index and self.items[i]
@@ -192,6 +306,10 @@ class SequenceMatcher(Matcher):
             return self.items[self.index].get_effective_matcher()
         return None
 
+    def get_state_key(self) -> tuple:
+        # Items after current one are not entered yet, so index is enough to describe them
+        return (self.symbol, self.index, self.items[self.index].get_state_key())
+
     def ensure_matcher(self, g: "Grammar", i=0) -> "SequenceMatcher":
         if not self.items[i]:
             self.items[i] = g.resolve(self.symbol.items[i]).enter(g)
@@ -199,23 +317,35 @@ class SequenceMatcher(Matcher):
 
     def get_allowed_tokens(self, g: "Grammar") -> AllowedTokens:
         assert self.index < len(self.items)
-        rv = self.items[self.index].get_allowed_tokens(g)
-        if rv.look_ahead:
-            i = self.index
-            ahead = rv
-            while i < len(self.symbol.items) - 1:
-                i += 1
-                self.ensure_matcher(g, i)
-                ahead = self.items[i].get_allowed_tokens(g)
-                rv = rv.combine(ahead)
-                if not ahead.look_ahead:
+        rv = g.get_allowed_tokens(self.items[self.index])
+        if rv.look_ahead and self.index < len(self.items) - 1:
+            # Tokens allowed by every following item up to first one that
+            # can't be skipped are allowed as well
+            end = self.symbol.get_next_required(g)[self.index + 1]
+            parts = [rv]
+            for i in range(self.index + 1, min(end + 1, len(self.items))):
+                if parts[-1].is_universal():
+                    # Nothing that follows can change the result
                     break
-            if not ahead.look_ahead:
-                rv.look_ahead = False
+                self.ensure_matcher(g, i)
+                parts.append(g.get_allowed_tokens(self.items[i]))
+            if end < len(self.items):
+                if len(parts) > 1:
+                    # New instance, so it can be modified
+                    rv = AllowedTokens.combine_all(parts)
+                    rv.look_ahead = False
+                else:
+                    # Current item already allows everything
+                    rv = AllowedTokens(allow_eos=True)
+            else:
+                rv = AllowedTokens.combine_all(parts)
         return rv
 
     def advance(self, g: "Grammar", token_id: int) -> Advance:
         a = self.items[self.index].advance(g, token_id)
+        if a == Advance.Again:
+            # By far most common case, item is still being matched
+            return a
         while True:
             if a in (Advance.Done, Advance.TryNext):
                 if self.index < len(self.symbol.items) - 1:
@@ -226,7 +356,11 @@ class SequenceMatcher(Matcher):
                             and isinstance(self.items[self.index - 1], RepeatMatcher)
                             and isinstance(self.items[self.index], TerminalMatcher)
                         ):
-                            a = self.items[self.index].enter_in_middle(g, token_id)
+                            # Token may start terminal as usual or end repeated item and then
+                            # continue into terminal
+                            a = self.items[self.index].advance(g, token_id)
+                            if a == Advance.Reject:
+                                a = self.items[self.index].enter_in_middle(g, token_id)
                             continue    # yep, this is a goto
                         return self.advance(g, token_id)
                     a = Advance.Again
@@ -237,40 +371,60 @@ class SequenceMatcher(Matcher):
 class AlternativeMatcher(Matcher):
     symbol: "Alternative"
 
-    def __init__(self, symbol: "Alternative", items: Set[Matcher]):
+    def __init__(self, symbol: "Alternative", items: List[Matcher]):
         super().__init__(symbol)
         self.items = items
+        # Bitmap of alternatives that still may match. Bit i represents self.items[i]
+        self.live = (1 << len(items)) - 1
+
+    def reset(self, g: "Grammar"):
+        for i in self.items:
+            i.reset(g)
+        self.live = (1 << len(self.items)) - 1
+
+    def clone(self) -> "AlternativeMatcher":
+        rv = copy.copy(self)
+        rv.items = [i.clone() for i in self.items]
+        return rv
+
+    def get_live(self) -> List[Matcher]:
+        return [self.items[i] for i in range(len(self.items)) if self.live >> i & 1]
 
     def debug(self):
-        return f'({" | ".join([x.debug() for x in self.items])})'
+        return f'({" | ".join([x.debug() for x in self.get_live()])})'
 
     def get_effective_matcher(self) -> "Matcher":
-        if len(self.items) == 1:
-            return list(self.items)[0].get_effective_matcher()
+        if self.live and not self.live & (self.live - 1):
+            # Exactly one alternative left
+            return self.items[self.live.bit_length() - 1].get_effective_matcher()
         return self
 
+    def get_state_key(self) -> tuple:
+        return (self.symbol, self.live, tuple(i.get_state_key() for i in self.get_live()))
+
     def get_allowed_tokens(self, g: "Grammar") -> AllowedTokens:
-        rv = None
-        for i in self.items:
-            a = i.get_allowed_tokens(g)
-            rv = rv.combine(a) if rv else a
+        parts = [g.get_allowed_tokens(i) for i in self.get_live()]
         # TODO: should this return 'ban everything' if no alternative is left?
         # TODO: should such state be even possible?
-        return rv or AllowedTokens()
+        return AllowedTokens.combine_all(parts) if parts else AllowedTokens()
 
     def advance(self, g: "Grammar", token_id: int) -> Advance:
         best_a = Advance.Reject
-        for i in list(self.items):
-            a = i.advance(g, token_id)
+        live = self.live
+        for i in range(len(self.items)):
+            if not live >> i & 1:
+                continue
+            a = self.items[i].advance(g, token_id)
             if a in (Advance.Reject, Advance.TryNext):
                 if a == Advance.TryNext and best_a == Advance.Reject:
                     best_a = Advance.TryNext
-                self.items.remove(i)
+                live &= ~(1 << i)
             else:
                 best_a = Advance.Done
                 if a == Advance.Done:
-                    self.items.remove(i)
-        if len(self.items) == 0:
+                    live &= ~(1 << i)
+        self.live = live
+        if not live:
             return best_a
         return Advance.Again
 
@@ -282,29 +436,48 @@ class RepeatMatcher(Matcher):
         super().__init__(symbol)
         self.effective_item = effective_item
         self.inside = False
+        # False while '+' haven't matched its first item yet
+        self.optional = symbol.mode != "+"
+
+    def reset(self, g: "Grammar"):
+        self.effective_item.reset(g)
+        self.inside = False
+        self.optional = self.symbol.mode != "+"
+
+    def clone(self) -> "RepeatMatcher":
+        rv = copy.copy(self)
+        rv.effective_item = self.effective_item.clone()
+        return rv
 
     def get_effective_matcher(self) -> "Matcher":
         return self.effective_item.get_effective_matcher() if self.inside else self
 
+    def get_state_key(self) -> tuple:
+        return (self.symbol, self.inside, self.optional, self.effective_item.get_state_key())
+
     def get_allowed_tokens(self, g: "Grammar") -> AllowedTokens:
-        rv = self.effective_item.get_allowed_tokens(g)
-        if not self.inside:
+        rv = g.get_allowed_tokens(self.effective_item)
+        if not self.inside and self.optional:
             return rv.set_ahead()
         return rv
 
     def advance(self, g: "Grammar", token_id: int) -> Advance:
         a = self.effective_item.advance(g, token_id)
+        if a == Advance.Again:
+            # By far most common case, checked first
+            self.inside = True
+            return a
         if a == Advance.Reject:
-            if self.inside:
-                return a
+            if self.inside or not self.optional:
+                return Advance.Reject
             return Advance.TryNext
         elif a == Advance.Done:
-            if self.symbol.mode == "*":
-                self.effective_item = g.resolve(self.symbol.item).enter(g)
+            if self.symbol.mode in "*+":
+                # Item is matched again from start. Resetting is cheaper than entering it again
+                self.effective_item.reset(g)
                 self.inside = False
+                self.optional = True
                 return Advance.Again
             else:   # mode == "?"
                 return Advance.Done
-        elif a == Advance.Again:
-            self.inside = True
         return a
@@ -2,6 +2,18 @@ from extensions.output_template.state_machine import *
 import re
 
 
+def clear_token_caches():
+    """
+    Drops token sets computed for previously used tokenizer.
+    Those are shared by all grammars, but valid only for one tokenizer.
+    """
+    Terminal.tokens_cache.clear()
+    Terminal.overlap_cache.clear()
+    RegExp.allowed_cache.clear()
+    RegExp.rejected_cache.clear()
+    RegExp.tokens_cache.clear()
+
+
 class Symbol:
     def validate(self, g: "Grammar"):
         """
@@ -13,6 +25,13 @@ class Symbol:
     def enter(self, g: "Grammar") -> Matcher:
         raise NotImplementedError(f"enter on {self.__class__.__name__}")
 
+    def is_nullable(self, g: "Grammar") -> bool:
+        """
+        Returns True if symbol can be matched by zero tokens and so next symbol
+        has to be considered as well.
+        """
+        return False
+
 
 class NonTerminal(Symbol):
     def __init__(self, name: str):
@@ -27,11 +46,19 @@ class NonTerminal(Symbol):
     def enter(self, g: "Grammar") -> Matcher:
         return g.resolve(self).enter(g)
 
+    def is_nullable(self, g: "Grammar") -> bool:
+        return g.resolve(self).is_nullable(g)
+
 
 class Terminal(Symbol):
+    # Shared by all terminals. Maps text to tokens that are its prefix
+    tokens_cache: Dict[str, AllowedTokens] = {}
+    # Maps text to tokens that end with its prefix and length of that prefix
+    overlap_cache: Dict[str, Dict[int, int]] = {}
+
     def __init__(self, value: str):
         self.value = value
-        self.allowed_cache = {}
+        self.allowed_cache: List[AllowedTokens] = []
 
     def __repr__(self):
         return f't{repr(self.value)}'
@@ -46,7 +73,8 @@ class Terminal(Symbol):
 
 class RegExp(Symbol):
     allowed_cache = {}
-    banned_cache = {}
+    rejected_cache = {}
+    tokens_cache = {}
 
     def __init__(self, value: str):
         self.value = value
@@ -112,12 +140,15 @@ class Sequence(Collection):
         super().__init__(items)
         self.effective = []
         self.index = 0
+        self.nullable: Optional[bool] = None
+        self.next_required: List[int] = []
 
     def validate(self, g: "Grammar"):
         super().validate(g)
         for i in range(len(self.items) - 1):
             if (True
                 and isinstance(self.items[i], Repeat)
+                and self.items[i].mode != "+"
                 and isinstance(self.items[i].item, RegExp)
                 and isinstance(g.resolve(self.items[i + 1]), Terminal)
             ):
@@ -127,11 +158,29 @@ class Sequence(Collection):
     def __repr__(self):
         return f'({" ".join([repr(x) for x in self.items])})'
 
+    def is_nullable(self, g: "Grammar") -> bool:
+        if self.nullable is None:
+            # Set before recursing so left-recursive rules don't loop forever
+            self.nullable = False
+            self.nullable = all(g.resolve(x).is_nullable(g) for x in self.items)
+        return self.nullable
+
+    def get_next_required(self, g: "Grammar") -> List[int]:
+        """
+        Returns list where value at index i is index of first non-nullable item at or after i.
+        Value at last index (same as number of items) is number of items, meaning that
+        rest of sequence can be skipped.
+        """
+        if not self.next_required:
+            next_required = [len(self.items)] * (len(self.items) + 1)
+            for i in reversed(range(len(self.items))):
+                next_required[i] = next_required[i + 1] if g.resolve(self.items[i]).is_nullable(g) else i
+            self.next_required = next_required
+        return self.next_required
+
     def enter(self, g: "Grammar") -> Matcher:
-        return SequenceMatcher(self, [
-            None
-            for m in self.items
-        ]).ensure_matcher(g)
+        # Only first item is entered now, rest is entered once sequence gets to it
+        return SequenceMatcher(self, [None] * len(self.items)).ensure_matcher(g)
 
 
 class Alternative(Collection):
@@ -142,7 +191,6 @@ class Alternative(Collection):
                 self.items += i.items
             else:
                 self.items.append(i)
-        self.possible = set()
 
     def __repr__(self):
         return f'({" | ".join([repr(x) for x in self.items])})'
@@ -151,16 +199,19 @@ class Alternative(Collection):
         for item in self.items:
             g.resolve(item).validate(g)
 
+    def is_nullable(self, g: "Grammar") -> bool:
+        return any(g.resolve(x).is_nullable(g) for x in self.items)
+
     def enter(self, g: "Grammar") -> "Matcher":
-        return AlternativeMatcher(self, {
+        return AlternativeMatcher(self, [
             g.resolve(m).enter(g)
             for m in self.items
-        })
+        ])
 
 
 class Repeat(Symbol):
     def __init__(self, mode: str, item: Symbol):
-        assert mode in "*?"
+        assert mode in "*?+"
         self.item = item
         self.mode = mode
 
@@ -173,5 +224,8 @@ class Repeat(Symbol):
     def validate(self, g: "Grammar"):
         self.item.validate(g)
 
+    def is_nullable(self, g: "Grammar") -> bool:
+        return self.mode != "+" or g.resolve(self.item).is_nullable(g)
+
     def enter(self, g: "Grammar") -> Matcher:
         return RepeatMatcher(self, g.resolve(self.item).enter(g))
@@ -7,7 +7,8 @@ from extensions.output_template.script import TemplatingLogitsProcessor, params
 from extensions.output_template.utils import encode, decode, shared, MINUS_INF
 from extensions.output_template.grammar import Grammar, Repeat, RegExp
 from torch import Tensor
-import math, random, json
+import torch
+import json
 
 EOS = shared.tokenizer.eos_token_id
 TEMPLATE = """
@@ -23,7 +24,8 @@ speech ::= "\\"" [^"\n]+ "\\""
 
 
 def random_scores():
-    return Tensor([[ 0.0001 + (math.floor(random.random() * 100) / 100.0) for _ in range(127) ]])
+    # Generated by torch at once, so tests measure processor and not building of scores
+    return (torch.rand(1, 127) * 100).floor_().div_(100.0).add_(0.0001)
 
 
 def set_score(token_id: Union[str, int, list], scores, value=1000.0):
@@ -77,6 +79,10 @@ def test_grammar_parser():
         root ::= "hi"
         # Testing case when grammar ends with non-terminated line with comment""")
 
+    # Consecutive terminals are merged, but not when repeated
+    g.reset("""root ::= "a" "b" [c] "d" 'e' "f"*""")
+    assert [repr(x) for x in g.rules["root"].items] == ["t'ab'", "r[c]", "t'de'", "(t'f')*"]
+
 
 def test_terminal():
     grammar: Grammar = params["grammar"]
@@ -92,6 +98,15 @@ def test_terminal():
     assert scores[..., encode("He")] > MINUS_INF
     assert scores[..., encode("H")] > MINUS_INF
     grammar.advance(encode("H")[0])
+    # Only one way to continue "ello "
+    assert grammar.get_current_allowed_tokens().get_single_token() == encode("ello ")[0]
+    # Stops at first token not allowed by grammar
+    assert grammar.clone().advance_many(encode("ello ") + encode("x")) == len(encode("ello "))
+    # Single possible token keeps its score
+    scores = random_scores()
+    score = float(scores[..., ord('e')])
+    grammar.update_scores(scores)
+    assert int((scores > MINUS_INF).sum()) == 1 and float(scores[..., ord('e')]) == score
     assert ord('e') == sample_test(random_scores())
     matcher = grammar.get_effective_matcher()
     while grammar.get_effective_matcher() is matcher:
@@ -102,6 +117,10 @@ def test_terminal():
 def test_alternate():
     grammar: Grammar = params["grammar"]
     grammar.reset(TEMPLATE)
+    # Same definition is not parsed again
+    rules = grammar.rules
+    grammar.reset(TEMPLATE)
+    assert grammar.rules is rules
     grammar.enter_rule("action")
     sample_test(set_score("/", random_scores()))
     text = get_text()
@@ -176,6 +195,23 @@ def test_repeat():
     text = get_text()
     assert "foo" in text or "ba" in text
 
+    # Tests that '+' requires at least one repetition
+    grammar.reset("""root ::= "a"+ "b" """)
+    scores = TemplatingLogitsProcessor()(None, random_scores())
+    assert scores[..., encode("b")] == MINUS_INF
+    assert ord("a") == sample_test(random_scores())
+    assert ord("b") == sample_test(set_score("b", random_scores()))
+
+    # Multi-character token may start terminal that follows repeat
+    END = encode("end")[0]
+    assert decode([END]) == "end"
+    for definition in ('[a-c]+ "end"', '"a"+ "end"', '[a-c]* "end"', '([0-9]+ " ")+ "end"'):
+        grammar.reset(f"root ::= {definition} .*")
+        for token_id in (encode("1 ") if "0-9" in definition else encode("a")):
+            grammar.advance(token_id)
+        grammar.advance(END)
+        assert isinstance(grammar.get_effective_matcher(), AnyTokenMatcher)
+
     # Actual case that was broken originally
     grammar: Grammar = params["grammar"]
     grammar.reset("""
@@ -227,7 +263,7 @@ def test_json():
         ws ::= ([ \\t\\n] ws)?
     """)
 
-    random.seed(2342343231)
+    torch.manual_seed(2342343231)
     # 1st token has to be {
     assert ord("{") == sample_test(random_scores())
     # Any number of whitespace has to be allowed
@@ -322,6 +358,32 @@ def test_allow_next():
     assert grammar.get_effective_matcher().symbol.value == "H"
 
 
+def test_batch():
+    """ Tests that every row of batch is matched separately, even when rows are reordered """
+    grammar: Grammar = params["grammar"]
+    grammar.reset("""root ::= ("a" | "b") "c" """)
+    A, B, C = encode("a")[0], encode("b")[0], encode("c")[0]
+    PROMPT = 5
+    processor = TemplatingLogitsProcessor()
+
+    def allowed(input_ids):
+        scores = processor(Tensor(input_ids).long(), Tensor([random_scores()[0].tolist()] * len(input_ids)))
+        return [{i for i in range(len(row)) if row[i] > MINUS_INF} for row in scores]
+
+    assert allowed([[PROMPT], [PROMPT]]) == [{A, B}, {A, B}]
+    assert allowed([[PROMPT, A], [PROMPT, B]]) == [{C}, {C}]
+    assert allowed([[PROMPT, B, C], [PROMPT, A, C], [PROMPT, A, C]]) == [{EOS}, {EOS}, {EOS}]
+    # Grammar used by single-row generation is not touched
+    assert repr(grammar.get_effective_matcher().symbol) == "(t'a' | t'b')"
+
+    # Rows in different states
+    grammar.reset("""root ::= ("a" | "bd") "c" """)
+    D = encode("d")[0]
+    processor = TemplatingLogitsProcessor()
+    assert allowed([[PROMPT], [PROMPT]]) == [{A, B}, {A, B}]
+    assert allowed([[PROMPT, A], [PROMPT, B]]) == [{C}, {D}]
+
+
 if __name__ == "__main__":
     params["scores_size"] = 127
     params["enabled"] = True
@@ -334,3 +396,4 @@ if __name__ == "__main__":
     test_json()
     test_any_token()
     test_allow_next()
+    test_batch()
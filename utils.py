@@ -1,6 +1,7 @@
-from typing import List, Set, Dict
-import torch, os
+from typing import List, Set, Dict, Callable, AbstractSet, Optional, Tuple
+import torch, os, re, bisect
 MINUS_INF = -float("inf")
+EMPTY: AbstractSet[int] = frozenset()
 
 
 if "OT_TESTING" in os.environ:
@@ -17,6 +18,27 @@ else:
         return shared.tokenizer.decode(token_ids)
 
 
+BIT_WEIGHTS = torch.tensor([1 << i for i in range(8)], dtype=torch.uint8)
+
+
+def to_bits(tokens: AbstractSet[int]) -> int:
+    """ Converts set of token ids into bitset stored in (arbitrary long) int """
+    if not tokens:
+        return 0
+    mask = torch.zeros((max(tokens) // 8 + 1) * 8, dtype=torch.bool)
+    mask.index_fill_(0, torch.tensor(list(tokens), dtype=torch.long), True)
+    packed = (mask.view(-1, 8).to(torch.uint8) * BIT_WEIGHTS).sum(1, dtype=torch.uint8)
+    return int.from_bytes(packed.numpy().tobytes(), "little")
+
+
+def from_bits(bits: int, size: int) -> torch.BoolTensor:
+    """ Converts bitset into bool tensor of given size """
+    nbytes = (size + 7) // 8
+    data = (bits & ((1 << size) - 1)).to_bytes(nbytes, "little")
+    packed = torch.frombuffer(bytearray(data), dtype=torch.uint8)
+    return (packed.unsqueeze(-1) & BIT_WEIGHTS).bool().view(-1)[:size]
+
+
 class AllowedTokens:
     """
     Utility class used to combine and eventually allow (or ban) generation of those tokens that may match
@@ -27,57 +49,167 @@ class AllowedTokens:
          If token is both allowed and banned, it's allowed. 
       2. if 'allowed' is not empty (and banned is), all but allowed tokens are banned.
       3. if 'allow_eos' is False, end-of-string token is banned in any case.
+         If it's True, end-of-string token is allowed in any case.
 
     'look_ahead' is used by Repeat symbol to signal that next symbol should also be considered.
+
+    Tokens may be given either as sets or as bitsets ('allowed_bits', 'banned_bits').
+    Combining is done on bitsets, so it doesn't iterate over tokens in python. Other
+    representation is computed only when needed.
+
+    Matchers cache and share instances of this class, so it should not be modified once created.
+    Mask applied on scores is computed only once for each device and size of vocabulary.
     """
-    def __init__(self, *, allowed=None, banned=None, look_ahead=False, allow_eos=False):
-        self.allowed: Set[int] = allowed or set()
-        self.banned: Set[int] = banned or set()
-        assert (self.allowed and not self.banned) or (self.banned and not self.allowed) or not (self.allowed and self.banned)
+    # Many instances are created and kept in caches, so they don't carry __dict__
+    __slots__ = ("_allowed", "_banned", "_allowed_bits", "_banned_bits", "look_ahead", "allow_eos",
+                 "masks", "indices", "parts", "_single")
+
+    def __init__(self, *, allowed=None, banned=None, allowed_bits=None, banned_bits=None,
+                 look_ahead=False, allow_eos=False):
+        self._allowed: Optional[AbstractSet[int]] = None if allowed_bits is not None else (allowed or EMPTY)
+        self._banned: Optional[AbstractSet[int]] = None if banned_bits is not None else (banned or EMPTY)
+        self._allowed_bits: Optional[int] = allowed_bits
+        self._banned_bits: Optional[int] = banned_bits
         self.look_ahead = look_ahead
         self.allow_eos = allow_eos
+        self.masks: Dict[tuple, torch.BoolTensor] = {}
+        # Indices of banned tokens, for masks that ban only few of them
+        self.indices: Dict[tuple, Optional[torch.LongTensor]] = {}
+        # Set on instances created by 'combine'
+        self.parts: Optional[Tuple["AllowedTokens", ...]] = None
+        # Computed by 'get_single_token', -1 means 'not computed yet'
+        self._single: Optional[int] = -1
+
+    @property
+    def allowed(self) -> AbstractSet[int]:
+        if self._allowed is None:
+            self._allowed = self._bits_to_set(self._allowed_bits)
+        return self._allowed
+
+    @property
+    def banned(self) -> AbstractSet[int]:
+        if self._banned is None:
+            self._banned = self._bits_to_set(self._banned_bits)
+        return self._banned
+
+    @property
+    def allowed_bits(self) -> int:
+        if self._allowed_bits is None:
+            self._allowed_bits = to_bits(self._allowed)
+        return self._allowed_bits
+
+    @property
+    def banned_bits(self) -> int:
+        if self._banned_bits is None:
+            self._banned_bits = to_bits(self._banned)
+        return self._banned_bits
+
+    @staticmethod
+    def _bits_to_set(bits: int) -> AbstractSet[int]:
+        if not bits:
+            return EMPTY
+        return frozenset(from_bits(bits, bits.bit_length()).nonzero().view(-1).tolist())
+
+    def is_universal(self) -> bool:
+        """ Returns True if every token, including EOS, is allowed. Such instance can't be changed by combining """
+        return self.allow_eos and not self.allowed_bits and not self.banned_bits
+
+    def get_single_token(self) -> Optional[int]:
+        """ Returns id of token if it's the only one that can be generated, None otherwise """
+        if self._single == -1:
+            self._single = None
+            bits = self.allowed_bits
+            if bits and not self.banned_bits:
+                if self.allow_eos:
+                    bits |= 1 << get_eos_token_id()
+                if not bits & (bits - 1):
+                    self._single = bits.bit_length() - 1
+        return self._single
+
+    def is_allowed(self, token_id: int) -> bool:
+        """ Returns True if token is not banned by mask this instance applies """
+        if token_id == get_eos_token_id():
+            return self.allow_eos
+        if self.banned_bits:
+            return not (self.banned_bits >> token_id) & 1 or bool((self.allowed_bits >> token_id) & 1)
+        if self.allowed_bits:
+            return bool((self.allowed_bits >> token_id) & 1)
+        return True
 
     def combine(self, other: "AllowedTokens") -> "AllowedTokens":
         """ Returns new instance which is combination of self and other """
-        allowed = set()
-        banned = set()
-        if (not self.allowed and not self.banned) or (not other.allowed and not other.banned):
-            # One of self/other is 'allow all'
-            pass
-        elif self.allowed and other.allowed:
-            # Both are 'allow only these'
-            assert not self.banned and not other.banned
-            allowed = self.allowed.union(other.allowed)
-        elif self.banned and other.banned:
-            # Both are 'ban only these'
-            assert not self.allowed and not other.allowed
-            banned = self.banned.intersection(other.banned)
-        elif self.allowed and other.banned:
-            # I have allowed tokens, other has banned tokens.
-            # Allow everything but those we both banned
-            assert not self.banned and not other.allowed
-            banned = other.banned - self.allowed
-        elif other.allowed and self.banned:
-            # As above but reversed
-            return other.combine(self)
-        else:
-            assert False, "impossible combination"
+        return AllowedTokens.combine_all([self, other])
 
-        return AllowedTokens(
-            allow_eos=self.allow_eos or other.allow_eos,
-            look_ahead=self.look_ahead or other.look_ahead,
-            allowed=allowed,
-            banned=banned,
+    @staticmethod
+    def combine_all(items: List["AllowedTokens"]) -> "AllowedTokens":
+        """
+        Returns combination of all given instances. Same as combining them one by one,
+        but without creating instance for every step.
+        Returns item itself if there's only one.
+        """
+        if len(items) == 1:
+            return items[0]
+        allowed = 0
+        banned = 0
+        allow_all = False
+        for (i, item) in enumerate(items):
+            assert not (item.allowed_bits and item.banned_bits), "impossible combination"
+            if not item.allowed_bits and not item.banned_bits:
+                # 'allow all' wins over everything
+                allow_all = True
+                break
+            elif i == 0:
+                allowed, banned = item.allowed_bits, item.banned_bits
+            elif allowed and item.allowed_bits:
+                # Both are 'allow only these'
+                allowed |= item.allowed_bits
+            elif banned and item.banned_bits:
+                # Both are 'ban only these'
+                banned &= item.banned_bits
+            elif allowed:
+                # Allowed tokens combined with banned tokens.
+                # Allow everything but those banned and not allowed
+                banned = item.banned_bits & ~allowed
+                allowed = 0
+            else:
+                banned &= ~item.allowed_bits
+            if not allowed and not banned:
+                # Everything got allowed
+                allow_all = True
+                break
+        if allow_all:
+            allowed = banned = 0
+
+        rv = AllowedTokens(
+            allow_eos=any(i.allow_eos for i in items),
+            look_ahead=any(i.look_ahead for i in items),
+            allowed_bits=allowed,
+            banned_bits=banned,
         )
+        rv.parts = tuple(items)
+        return rv
+
+    def _copy(self, **kwargs) -> "AllowedTokens":
+        rv = AllowedTokens(**{
+            "allow_eos": self.allow_eos,
+            "look_ahead": self.look_ahead,
+            **kwargs
+        })
+        rv._allowed, rv._banned = self._allowed, self._banned
+        rv._allowed_bits, rv._banned_bits = self._allowed_bits, self._banned_bits
+        return rv
 
     def set_ahead(self):
         """ Returns copy of self with 'look_ahead' set to True """
-        return AllowedTokens(
-            allow_eos=self.allow_eos,
-            allowed=self.allowed,
-            banned=self.banned,
-            look_ahead=True,
-        )
+        rv = self._copy(look_ahead=True)
+        # 'look_ahead' doesn't change mask, so it can be shared
+        rv.masks = self.masks
+        rv.indices = self.indices
+        return rv
+
+    def set_eos(self):
+        """ Returns copy of self with 'allow_eos' set to True """
+        return self._copy(allow_eos=True)
 
     def __repr__(self):
         data = []
@@ -86,29 +218,94 @@ class AllowedTokens:
                 "ahead" if self.look_ahead else "",
                 "eos" if self.allow_eos else ""
             ]).strip(","))
-        data.append(f"allowed={self.allowed}")
-        data.append(f"banned={self.banned}")
+        data.append(f"allowed={set(self.allowed)}")
+        data.append(f"banned={set(self.banned)}")
         return f"<AllowedTokens {' '.join(data)}>"
 
-    def apply(self, scores: torch.FloatTensor):
-        if self.allowed and not self.banned:
-            s = scores.new_full(scores.shape, False, dtype=torch.bool)
-            for a in self.allowed:
-                s[..., a] = True
+    def get_banned_mask(self, scores: torch.FloatTensor) -> torch.BoolTensor:
+        """
+        Returns tensor of same device and vocabulary size as 'scores' with True
+        set for every token that should be banned.
+        """
+        size = scores.shape[-1]
+        key = (size, scores.device)
+        if key not in self.masks and self.parts:
+            # In every case handled by 'combine', token is banned only if it's banned by all parts.
+            # Masks of parts are usually shared by many states and this way they are
+            # combined on scores device, without building anything on CPU.
+            mask = self.parts[0].get_banned_mask(scores).clone()
+            for part in self.parts[1:]:
+                # In place, so there's only one new tensor no matter how many parts are there
+                mask &= part.get_banned_mask(scores)
+            self.masks[key] = mask
+        if key not in self.masks:
+            # Mask is built on CPU and then copied to scores device just once
+            eos_token_id = get_eos_token_id()
+            if self.allowed_bits and not self.banned_bits:
+                bits = self.allowed_bits
+            elif self.banned_bits:
+                # Token both allowed and banned is allowed
+                bits = ((1 << size) - 1) & ~self.banned_bits | self.allowed_bits
+            else:
+                bits = (1 << size) - 1
             if self.allow_eos:
-                s[..., shared.tokenizer.eos_token_id] = True
-            scores[~s] = MINUS_INF
-        if self.banned or not self.allow_eos:
-            s = scores.new_full(scores.shape, True, dtype=torch.bool)
-            for a in self.banned:
-                if a not in self.allowed:
-                    s[..., a] = False
-            if not self.allow_eos:
-                s[..., shared.tokenizer.eos_token_id] = False
-            scores[~s] = MINUS_INF
+                bits |= 1 << eos_token_id
+            else:
+                bits &= ~(1 << eos_token_id)
+            mask = ~from_bits(bits, size)
+            if scores.device.type == "cuda":
+                # Pinned memory allows to copy without waiting for transfer to finish
+                mask = mask.pin_memory().to(scores.device, non_blocking=True)
+            self.masks[key] = mask.to(scores.device)
+        return self.masks[key]
+
+    def apply(self, scores: torch.FloatTensor):
+        if self.is_universal():
+            # Nothing to ban (e.g. inside '.*')
+            return
+        token_id = self.get_single_token()
+        if token_id is not None and token_id < scores.shape[-1]:
+            # Only one token can be generated. Banning everything else doesn't need any mask
+            kept = scores[..., token_id].clone()
+            scores.fill_(MINUS_INF)
+            scores[..., token_id] = kept
+            return
+        mask = self.get_banned_mask(scores)
+        key = (scores.shape[-1], scores.device)
+        if key not in self.indices:
+            index = mask.nonzero().view(-1)
+            # Scattering few values is cheaper than going over entire mask
+            self.indices[key] = index if len(index) < len(mask) // 2 else None
+        index = self.indices[key]
+        if index is None:
+            scores.masked_fill_(mask, MINUS_INF)
+        else:
+            scores.index_fill_(-1, index, MINUS_INF)
+
+
+# Tokenizer and its EOS token id, converted to int
+eos_snapshot = (None, None)
+
+
+def get_eos_token_id() -> int:
+    """ Returns EOS token id of current tokenizer, without converting it on every call """
+    global eos_snapshot
+    tokenizer, eos_token_id = eos_snapshot
+    if eos_token_id is None or tokenizer is not shared.tokenizer:
+        eos_token_id = int(shared.tokenizer.eos_token_id)
+        eos_snapshot = (shared.tokenizer, eos_token_id)
+    return eos_token_id
+
+
+# Tokenizer and dictionary built for it. Allows common case to skip import and lookups in params
+dictionary_snapshot = (None, None)
 
 
 def get_token_dictionary() -> Dict[int, str]:
+    global dictionary_snapshot
+    tokenizer, d = dictionary_snapshot
+    if d and tokenizer is shared.tokenizer:
+        return d
     from extensions.output_template.script import params, logger
     if not params["token_dictionary"] or params["used_tokenizer"] is not shared.tokenizer:
         assert params["scores_size"]
@@ -122,20 +319,176 @@ def get_token_dictionary() -> Dict[int, str]:
                     return shared.tokenizer.convert_ids_to_tokens(i)
                 except IndexError:
                     return None
+            ids = list(range(params["scores_size"]))
+            try:
+                # Converting all ids in single call lets (usually compiled) tokenizer do the loop
+                tokens = shared.tokenizer.convert_ids_to_tokens(ids)
+            except IndexError:
+                tokens = [convert_ids_to_tokens(i) for i in ids]
+            to_decode = [i for i in ids if tokens[i] and "▁" not in tokens[i]]
+            decoded = dict(zip(to_decode, shared.tokenizer.batch_decode([[i] for i in to_decode])))
             params["token_dictionary"] = {
-                token_id: (
-                    shared.tokenizer.decode([token_id])
-                    if "▁" not in tmp
-                    else tmp.replace("▁", " ")
-                )
-                for (token_id, tmp) in (
-                    (i, convert_ids_to_tokens(i))
-                    for i in range(params["scores_size"])
-                )
-                if tmp
+                i: decoded[i] if i in decoded else tokens[i].replace("▁", " ")
+                for i in ids
+                if tokens[i]
             }
-        # import json
-        # open("/tmp/dict.json", "w").write(json.dumps(params["token_dictionary"]))
         params["used_tokenizer"] = shared.tokenizer
+        params["token_trie"] = None
+        params["token_blob"] = None
+        from extensions.output_template.symbols import clear_token_caches
+        clear_token_caches()
         logger.info("output_template: Done creating token dictionary.")
+    dictionary_snapshot = (shared.tokenizer, params["token_dictionary"])
     return params["token_dictionary"]
+
+
+class TokenTrie:
+    """
+    Prefix tree built from token dictionary.
+
+    Nodes are stored as two parallel lists: 'children' maps character to index of child node
+    and 'tokens' lists ids of tokens that end at given node. Node 0 is root.
+    Walking the tree allows to find matching tokens without testing every token in dictionary
+    and skipping entire subtree once its prefix can't match.
+    """
+    def __init__(self, d: Dict[int, str]):
+        self.children: List[Dict[str, int]] = [{}]
+        self.tokens: List[List[int]] = [[]]
+        for (token_id, token) in d.items():
+            node = 0
+            for c in token or "":
+                child = self.children[node].get(c)
+                if child is None:
+                    child = len(self.children)
+                    self.children[node][c] = child
+                    self.children.append({})
+                    self.tokens.append([])
+                node = child
+            self.tokens[node].append(token_id)
+
+    def prefixes_of(self, text: str) -> Set[int]:
+        """ Returns ids of all (non-empty) tokens that are prefix of given text """
+        rv = set()
+        node = 0
+        for c in text:
+            node = self.children[node].get(c)
+            if node is None:
+                break
+            rv.update(self.tokens[node])
+        return rv
+
+    def subtree(self, node: int) -> Set[int]:
+        """ Returns ids of all tokens starting with prefix represented by given node """
+        rv = set()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            rv.update(self.tokens[node])
+            stack += self.children[node].values()
+        return rv
+
+    def consisting_of(self, accept: Callable[[str], bool], max_length=0) -> Set[int]:
+        """
+        Returns ids of all (non-empty) tokens consisting only of characters for which 'accept' returns True.
+        If 'max_length' is set, only tokens up to that many characters are returned.
+        """
+        rv = set()
+        accepted: Dict[str, bool] = {}
+        stack = [(0, 0)]
+        while stack:
+            node, depth = stack.pop()
+            if depth:
+                rv.update(self.tokens[node])
+            if max_length and depth >= max_length:
+                continue
+            for (c, child) in self.children[node].items():
+                if c not in accepted:
+                    accepted[c] = bool(accept(c))
+                if accepted[c]:
+                    stack.append((child, depth + 1))
+        return rv
+
+    def containing(self, reject: Callable[[str], bool]) -> Set[int]:
+        """ Returns ids of all tokens containing at least one character for which 'reject' returns True """
+        rv = set()
+        rejected: Dict[str, bool] = {}
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            for (c, child) in self.children[node].items():
+                if c not in rejected:
+                    rejected[c] = bool(reject(c))
+                if rejected[c]:
+                    rv.update(self.subtree(child))
+                else:
+                    stack.append(child)
+        return rv
+
+
+def get_token_trie() -> TokenTrie:
+    """ Returns TokenTrie built from token dictionary. Built only once, same as dictionary itself """
+    from extensions.output_template.script import params
+    d = get_token_dictionary()
+    if not params["token_trie"]:
+        params["token_trie"] = TokenTrie(d)
+    return params["token_trie"]
+
+
+class TokenBlob:
+    """
+    Entire token dictionary joined into single string, with tokens separated by SEPARATOR.
+
+    Allows to find tokens containing match of regular expression by scanning whole vocabulary
+    with (C-implemented) regexp engine, instead of testing tokens one by one.
+    Tokens consisting only of matching characters are still found faster with TokenTrie,
+    which skips entire subtrees.
+    """
+    SEPARATOR = "\x00"
+
+    def __init__(self, d: Dict[int, str]):
+        self.ids: List[int] = []
+        self.starts: List[int] = []
+        parts = []
+        pos = 1
+        for (token_id, token) in d.items():
+            token = token or ""
+            self.ids.append(token_id)
+            self.starts.append(pos)
+            parts.append(token)
+            pos += len(token) + 1
+        self.blob = self.SEPARATOR + self.SEPARATOR.join(parts) + self.SEPARATOR
+
+    def can_scan(self, pattern: re.Pattern) -> bool:
+        """ Returns False if pattern may match separator, in which case results would be wrong """
+        return not pattern.search(self.SEPARATOR)
+
+    def ending_with(self, text: str) -> Set[int]:
+        """ Returns ids of all tokens that end with given text """
+        assert text and self.SEPARATOR not in text
+        pattern = re.compile(re.escape(text) + f"(?={self.SEPARATOR})")
+        return {
+            self.ids[bisect.bisect_right(self.starts, m.start()) - 1]
+            for m in pattern.finditer(self.blob)
+        }
+
+    def containing(self, pattern: re.Pattern) -> Set[int]:
+        """ Returns ids of all tokens containing at least one match of given pattern """
+        rv = set()
+        m = pattern.search(self.blob)
+        while m:
+            i = bisect.bisect_right(self.starts, m.start()) - 1
+            rv.add(self.ids[i])
+            if i + 1 >= len(self.starts):
+                break
+            # Rest of this token doesn't matter anymore
+            m = pattern.search(self.blob, self.starts[i + 1])
+        return rv
+
+
+def get_token_blob() -> TokenBlob:
+    """ Returns TokenBlob built from token dictionary. Built only once, same as dictionary itself """
+    from extensions.output_template.script import params
+    d = get_token_dictionary()
+    if not params["token_blob"]:
+        params["token_blob"] = TokenBlob(d)
+    return params["token_blob"]